@@ -1,17 +1,34 @@
-from typing import Optional, List, Dict, Any
-from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple
+from datetime import datetime, timedelta, timezone as dt_timezone, time as dtime
 from pydantic import BaseModel, Field, ConfigDict
 import logging
+import numpy as np
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import os
+import json
 import time
+import functools
+import itertools
+import random
+import httplib2
 from crewai import Agent, Task, Crew
 from crewai.tools import tool
 from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 
+# ISO 8601 parsing: use the ciso8601 C parser when installed, else the stdlib
+try:
+    from ciso8601 import parse_datetime
+except ImportError:
+    def parse_datetime(value: str) -> datetime:
+        # fromisoformat only accepts a trailing 'Z' from Python 3.11
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
 # Load environment variables
 load_dotenv()
 
@@ -26,6 +43,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Scheduling window (UTC) and slot granularity
+WORK_START = dtime(10, 0)
+WORK_END = dtime(17, 0)
+WORK_START_SECONDS = WORK_START.hour * 3600 + WORK_START.minute * 60
+WORK_END_SECONDS = WORK_END.hour * 3600 + WORK_END.minute * 60
+SLOT_STEP_SECONDS = 15 * 60
+SECONDS_PER_DAY = 24 * 3600
+
+# HTTP statuses worth retrying when calling the Calendar API
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Process-wide counter that keeps conference requestIds unique
+_request_counter = itertools.count()
+
+# Static parts of every created event
+_REMINDERS = {
+    'useDefault': False,
+    'overrides': [
+        {'method': 'email', 'minutes': 24 * 60},  # 1 day before
+        {'method': 'popup', 'minutes': 30},      # 30 minutes before
+    ]
+}
+_CONF_KEY = {'type': 'hangoutsMeet'}
+_GUEST_FLAGS = {
+    'guestsCanInviteOthers': False,
+    'guestsCanModify': False,
+    'guestsCanSeeOtherGuests': True,
+}
+
 # Data Models
 class CalendarEventDetails(BaseModel):
     model_config = ConfigDict(extra='forbid')
@@ -53,10 +99,55 @@ class AvailableSlotsResponse(BaseModel):
     selected_slot: Optional[TimeSlot]
     notes: str
 
+@functools.lru_cache(maxsize=1024)
+def _parse_iso(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp (accepting a trailing 'Z'), memoized across calls"""
+    return parse_datetime(value)
+
+# Busy interval preprocessing
+def merge_busy_intervals(busy_starts: np.ndarray, busy_ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sort busy intervals by start and coalesce overlapping or back-to-back ones."""
+    if len(busy_starts) == 0:
+        return busy_starts, busy_ends
+    order = np.argsort(busy_starts, kind='stable')
+    starts = busy_starts[order]
+    max_ends = np.maximum.accumulate(busy_ends[order])
+    
+    # A merged interval begins wherever a start lies after every earlier end
+    new_group = np.empty(len(starts), dtype=bool)
+    new_group[0] = True
+    new_group[1:] = starts[1:] > max_ends[:-1]
+    group_starts = np.flatnonzero(new_group)
+    group_ends = np.append(group_starts[1:] - 1, len(starts) - 1)
+    return starts[group_starts], max_ends[group_ends]
+
+# Slot overlap kernel
+def busy_slot_masks(midnight_ts: int, days_ahead: int, slot_count: int, duration_seconds: int,
+                    busy_starts: List[int], busy_ends: List[int]) -> Dict[int, int]:
+    """Map day offsets to bitmasks of the candidate slots blocked by busy intervals.
+
+    Bit i of a day's mask is set when the slot starting i * 15 minutes after 10 AM
+    on that day overlaps a busy interval. Days without conflicts are omitted.
+    """
+    masks = {}
+    last_slot_offset = WORK_START_SECONDS + (slot_count - 1) * SLOT_STEP_SECONDS
+    for busy_start, busy_end in zip(busy_starts, busy_ends):
+        # A slot starting at s overlaps the interval iff busy_start - duration < s < busy_end
+        first_day = max((busy_start - duration_seconds - midnight_ts - last_slot_offset) // SECONDS_PER_DAY, 0)
+        last_day = min((busy_end - 1 - midnight_ts - WORK_START_SECONDS) // SECONDS_PER_DAY, days_ahead - 1)
+        for day in range(first_day, last_day + 1):
+            window_start = midnight_ts + day * SECONDS_PER_DAY + WORK_START_SECONDS
+            lo = max((busy_start - duration_seconds - window_start) // SLOT_STEP_SECONDS + 1, 0)
+            hi = min(-((window_start - busy_end) // SLOT_STEP_SECONDS), slot_count)
+            if lo < hi:
+                masks[day] = masks.get(day, 0) | (((1 << hi) - 1) ^ ((1 << lo) - 1))
+    return masks
+
 # Google Calendar Service
 class CalendarService:
-    def __init__(self, credentials_path: str = './credentials.json'):
+    def __init__(self, credentials_path: str = './credentials.json', token_path: str = './token.json'):
         self.credentials_path = credentials_path
+        self.token_path = token_path
         self.scopes = [
             'https://www.googleapis.com/auth/calendar',
             'https://www.googleapis.com/auth/calendar.events',
@@ -66,30 +157,55 @@ class CalendarService:
         self.service = self._authenticate()
         if not self.verify_credentials():
             logger.error("Credential verification failed - recreating service")
-            self.service = self._authenticate()
+            self.service = self._authenticate(force_flow=True)
     
-    def _authenticate(self):
-        """Authenticate with Google Calendar API"""
+    def _authenticate(self, force_flow: bool = False):
+        """Authenticate with Google Calendar API, reusing the stored token when possible"""
         try:
-            if not os.path.exists(self.credentials_path):
-                raise FileNotFoundError("Credentials file not found")
-            
-            flow = InstalledAppFlow.from_client_secrets_file(
-                self.credentials_path, self.scopes)
-            creds = flow.run_local_server(port=0)
+            creds = None
+            if not force_flow and os.path.exists(self.token_path):
+                try:
+                    creds = Credentials.from_authorized_user_file(self.token_path, self.scopes)
+                except (ValueError, json.JSONDecodeError) as e:
+                    logger.warning(f"Stored token is unusable, re-running OAuth flow: {e}")
+                
+                if creds and creds.expired and creds.refresh_token:
+                    try:
+                        creds.refresh(Request())
+                        self._save_token(creds)
+                    except RefreshError as e:
+                        logger.warning(f"Token refresh failed, re-running OAuth flow: {e}")
+                        creds = None
             
-            with open('token.json', 'w') as token:
-                token.write(creds.to_json())
+            if not creds or not creds.valid:
+                if not os.path.exists(self.credentials_path):
+                    raise FileNotFoundError("Credentials file not found")
+                
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    self.credentials_path, self.scopes)
+                creds = flow.run_local_server(port=0)
+                self._save_token(creds)
                 
             return build('calendar', 'v3', credentials=creds)
         except Exception as e:
             logger.error(f"Authentication failed: {e}")
             raise
 
+    def _save_token(self, creds: Credentials):
+        """Persist credentials so later runs can skip the OAuth flow, skipping unchanged writes"""
+        token_json = creds.to_json()
+        if os.path.exists(self.token_path):
+            with open(self.token_path) as token:
+                if token.read() == token_json:
+                    return
+        
+        with open(self.token_path, 'w') as token:
+            token.write(token_json)
+
     def verify_credentials(self):
         """Verify that credentials have the necessary permissions"""
         try:
-            creds = Credentials.from_authorized_user_file('token.json', self.scopes)
+            creds = Credentials.from_authorized_user_file(self.token_path, self.scopes)
             if not creds.valid:
                 logger.warning("Credentials are not valid or have expired")
                 return False
@@ -105,78 +221,106 @@ class CalendarService:
             return False
 
     @tool("Find Available Time Slots")
-    def find_available_slots(self, duration_minutes: int, days_ahead: int = 7) -> Dict[str, Any]:
-        """Finds available time slots between 10 AM and 5 PM in the next specified days."""
+    def find_available_slots(self, duration_minutes: int, days_ahead: int = 7,
+                             attendees: Optional[List[str]] = None, only_first: bool = True) -> str:
+        """Finds available time slots between 10 AM and 5 PM in the next specified days when the organizer and all attendees are free. Returns only the earliest slot unless only_first is False."""
         try:
-            # Get current time in UTC
-            now = datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
+            # Get current time in UTC once so every bound below agrees on "now"
+            utc_now = datetime.utcnow()
+            now = utc_now.isoformat() + 'Z'  # 'Z' indicates UTC time
             
             # Calculate end time for query (days_ahead days from now)
-            end_date = (datetime.utcnow() + timedelta(days=days_ahead)).isoformat() + 'Z'
+            end_date = (utc_now + timedelta(days=days_ahead)).isoformat() + 'Z'
             
-            # Get busy intervals from calendar
+            # Get busy intervals for the organizer and all attendees in a single request
+            calendar_ids = list(dict.fromkeys(['primary', *(attendees or [])]))
             freebusy_query = {
                 "timeMin": now,
                 "timeMax": end_date,
-                "items": [{"id": "primary"}]
+                "items": [{"id": calendar_id} for calendar_id in calendar_ids]
             }
             
-            freebusy_result = self.service.freebusy().query(body=freebusy_query).execute()
-            busy_slots = freebusy_result.get('calendars', {}).get('primary', {}).get('busy', [])
+            freebusy_result = self.service.freebusy().query(body=freebusy_query, fields='calendars').execute()
+            busy_slots = []
+            unreadable_calendars = []
+            for calendar_id, calendar in freebusy_result.get('calendars', {}).items():
+                if calendar.get('errors'):
+                    logger.warning(f"Could not read availability for {calendar_id}: {calendar['errors']}")
+                    unreadable_calendars.append(calendar_id)
+                busy_slots.extend(calendar.get('busy', []))
             
-            # Generate potential slots (10 AM to 5 PM)
-            available_slots = []
-            current_date = datetime.utcnow().date()
+            # Tell the agent whose availability was assumed rather than checked
+            availability_note = ""
+            if unreadable_calendars:
+                availability_note = ". Availability could not be checked for: {}".format(", ".join(unreadable_calendars))
             
-            for day in range(days_ahead):
-                day_date = current_date + timedelta(days=day)
-                
-                # Skip weekends
-                if day_date.weekday() >= 5:  # 5 and 6 are Saturday and Sunday
-                    continue
-                
-                # Create time slots from 10 AM to 5 PM
-                start_time = datetime.combine(day_date, datetime.strptime("10:00", "%H:%M").time())
-                end_time = datetime.combine(day_date, datetime.strptime("17:00", "%H:%M").time())
-                
-                # Generate slots of the requested duration
-                slot_start = start_time
-                while slot_start + timedelta(minutes=duration_minutes) <= end_time:
-                    slot_end = slot_start + timedelta(minutes=duration_minutes)
-                    
-                    # Check if this slot overlaps with any busy time
-                    slot_is_free = True
-                    for busy in busy_slots:
-                        busy_start = datetime.fromisoformat(busy['start'].replace('Z', '+00:00'))
-                        busy_end = datetime.fromisoformat(busy['end'].replace('Z', '+00:00'))
-                        
-                        if not (slot_end <= busy_start or slot_start >= busy_end):
-                            slot_is_free = False
-                            break
-                    
-                    if slot_is_free:
-                        available_slots.append(TimeSlot(
-                            start=slot_start.isoformat(),
-                            end=slot_end.isoformat()
-                        ))
-                    
-                    slot_start += timedelta(minutes=15)  # Check every 15 minutes
+            # Parse busy intervals once into parallel start/end epoch-second arrays
+            busy_starts = np.fromiter(
+                (int(_parse_iso(busy['start']).timestamp()) for busy in busy_slots),
+                dtype=np.int64, count=len(busy_slots)
+            )
+            busy_ends = np.fromiter(
+                (int(_parse_iso(busy['end']).timestamp()) for busy in busy_slots),
+                dtype=np.int64, count=len(busy_slots)
+            )
+            # Back-to-back meetings and overlapping attendee calendars collapse into fewer intervals
+            busy_starts, busy_ends = merge_busy_intervals(busy_starts, busy_ends)
+            
+            # Generate potential slot starts (10 AM to 5 PM) as UTC epoch seconds
+            duration_seconds = duration_minutes * 60
+            current_date = utc_now.date()
+            midnight_ts = int(datetime.combine(current_date, dtime(0), tzinfo=dt_timezone.utc).timestamp())
+            
+            # Day offsets that fall on weekdays (weekday() 5 and 6 are Saturday and Sunday)
+            day_offsets = np.arange(days_ahead, dtype=np.int64)
+            work_days = day_offsets[(day_offsets + current_date.weekday()) % 7 < 5]
+            
+            # One bit per 15-minute slot start from 10 AM that still ends by 5 PM
+            slot_count = max((WORK_END_SECONDS - WORK_START_SECONDS - duration_seconds) // SLOT_STEP_SECONDS + 1, 0)
+            all_slots = (1 << slot_count) - 1
+            busy_masks = busy_slot_masks(
+                midnight_ts, days_ahead, slot_count, duration_seconds, busy_starts.tolist(), busy_ends.tolist()
+            )
+            
+            free_starts = []
+            for day in work_days.tolist():
+                free_bits = all_slots & ~busy_masks.get(day, 0)
+                window_start = midnight_ts + day * SECONDS_PER_DAY + WORK_START_SECONDS
+                while free_bits:
+                    # Take the lowest set bit, i.e. the earliest free slot left in the day
+                    lowest = free_bits & -free_bits
+                    free_starts.append(window_start + (lowest.bit_length() - 1) * SLOT_STEP_SECONDS)
+                    free_bits ^= lowest
+                    if only_first:
+                        break
+                if only_first and free_starts:
+                    break
+            
+            # Slots and responses are built from trusted values, so skip validation
+            available_slots = [
+                TimeSlot.model_construct(
+                    start=datetime.utcfromtimestamp(start).isoformat(),
+                    end=datetime.utcfromtimestamp(start + duration_seconds).isoformat()
+                )
+                for start in free_starts
+            ]
             
             if not available_slots:
-                return AvailableSlotsResponse(
+                return AvailableSlotsResponse.model_construct(
                     available_slots=[],
                     selected_slot=None,
-                    notes="No available slots found between 10 AM and 5 PM in the next {} days".format(days_ahead)
-                ).model_dump()
+                    notes="No available slots found between 10 AM and 5 PM in the next {} days".format(days_ahead) + availability_note
+                ).model_dump_json()
             
             # Select the earliest available slot
             selected_slot = available_slots[0]
             
-            return AvailableSlotsResponse(
+            return AvailableSlotsResponse.model_construct(
                 available_slots=available_slots,
                 selected_slot=selected_slot,
-                notes="Found {} available slots between 10 AM and 5 PM".format(len(available_slots))
-            )
+                notes=("Found the earliest available slot between 10 AM and 5 PM" if only_first
+                       else "Found {} available slots between 10 AM and 5 PM".format(len(available_slots))) + availability_note
+            ).model_dump_json()
             
         except Exception as e:
             logger.error(f"Failed to find available slots: {e}")
@@ -184,15 +328,16 @@ class CalendarService:
                 available_slots=[],
                 selected_slot=None,
                 notes=f"Error finding slots: {str(e)}"
-            ).model_dump()
+            ).model_dump_json()
 
     @tool("Create Google Calendar Event")
-    def create_event(self, event_details: Dict[str, Any]) -> Dict[str, Any]:
+    def create_event(self, event_details: Dict[str, Any]) -> str:
         """Creates a new calendar event with the provided details and sends notifications to attendees."""
         try:
             details = CalendarEventDetails(**event_details)
 
             event = {
+                **_GUEST_FLAGS,
                 'summary': details.summary,
                 'description': details.description,
                 'start': {'dateTime': details.start_time, 'timeZone': details.timezone},
@@ -200,20 +345,11 @@ class CalendarService:
                 'attendees': [{'email': email} for email in details.attendees],
                 'conferenceData': {
                     'createRequest': {
-                        'requestId': f"event_{datetime.now().timestamp()}",
-                        'conferenceSolutionKey': {'type': 'hangoutsMeet'}
+                        'requestId': f"event_{time.monotonic_ns()}_{next(_request_counter)}",
+                        'conferenceSolutionKey': _CONF_KEY
                     }
                 },
-                'reminders': {
-                    'useDefault': False,
-                    'overrides': [
-                        {'method': 'email', 'minutes': 24 * 60},  # 1 day before
-                        {'method': 'popup', 'minutes': 30},      # 30 minutes before
-                    ]
-                },
-                'guestsCanInviteOthers': False,
-                'guestsCanModify': False,
-                'guestsCanSeeOtherGuests': True,
+                'reminders': _REMINDERS,
             }
 
             # Create event WITH sending notifications (with retry logic)
@@ -230,46 +366,59 @@ class CalendarService:
                         conferenceDataVersion=1,
                         sendUpdates='all',
                         sendNotifications=True,
-                        supportsAttachments=False
+                        supportsAttachments=False,
+                        fields='id,htmlLink,hangoutLink,attendees(email,responseStatus)'
                     ).execute()
                     notifications_sent = True
                     break
-                except Exception as e:
+                except (HttpError, httplib2.HttpLib2Error, OSError) as e:
+                    # Client errors (bad request, auth, not found) won't succeed on retry
+                    if isinstance(e, HttpError) and e.resp.status not in RETRYABLE_STATUSES:
+                        raise
                     retry_count += 1
                     logger.warning(f"Attempt {retry_count} failed: {e}")
                     if retry_count == max_retries:
                         raise
-                    time.sleep(2 ** retry_count)
+                    # Exponential backoff with jitter to avoid synchronized retries
+                    time.sleep(min(2 ** retry_count, 30) * (0.5 + random.random()))
 
             if notifications_sent:
                 logger.info("Email notifications successfully sent to attendees.")
             else:
                 logger.warning("Failed to send email notifications to attendees.")
 
-            if 'attendees' in created_event:
-                for attendee in created_event['attendees']:
-                    if attendee.get('responseStatus') == 'needsAction':
-                        logger.warning(f"Notification may not have reached {attendee.get('email')}")
-                    else:
-                        logger.info(f"Notification confirmed for {attendee.get('email')}")
+            # One aggregated record per status instead of one per attendee
+            attendees = created_event.get('attendees', [])
+            needs_action = [a for a in attendees if a.get('responseStatus') == 'needsAction']
+            if needs_action:
+                logger.warning("Notification may not have reached: %s",
+                               ", ".join(str(a.get('email')) for a in needs_action))
+            logger.info("Notification confirmed for %d attendees", len(attendees) - len(needs_action))
 
             return CalendarEventResponse(
                 status="success",
                 event_link=created_event.get('htmlLink'),
                 meet_link=created_event.get('hangoutLink'),
                 event_id=created_event.get('id')
-            ).model_dump()
+            ).model_dump_json()
 
         except Exception as e:
             logger.error(f"Event creation failed: {e}")
             return CalendarEventResponse(
                 status="error",
                 error_message=str(e)
-            ).model_dump()
+            ).model_dump_json()
+
+@functools.lru_cache(maxsize=1)
+def get_calendar_service() -> CalendarService:
+    """Return a process-wide authenticated CalendarService"""
+    return CalendarService()
 
 # Crew Setup
+@functools.lru_cache(maxsize=1)
 def create_scheduling_crew():
-    calendar_service = CalendarService()
+    """Build the scheduling crew template once per process; kick off a .copy() of it, never the template"""
+    calendar_service = get_calendar_service()
     
     llm = ChatOpenAI(
         model="gpt-4-turbo",
@@ -309,7 +458,8 @@ def create_scheduling_crew():
    
     find_slots_task = Task(
         description="""Find available time slots between 10 AM and 5 PM for a 
-        {duration_minutes}-minute meeting with {attendees}. Look for slots in the next 7 days.""",
+        {duration_minutes}-minute meeting with {attendees}. Look for slots in the next 7 days
+        and pass the attendee emails so their calendars are checked too.""",
         agent=scheduler_agent,
         expected_output="""A dictionary containing:
         - 'available_slots': List of available time slots between 10 AM and 5 PM
@@ -400,7 +550,9 @@ def schedule_meeting_with_crew(
 ):
     """Schedule a meeting between 10 AM and 5 PM with email notifications to attendees"""
     try:
-        crew = create_scheduling_crew()
+        # kickoff() fills in task descriptions and outputs in place, so each meeting
+        # runs on its own copy of the cached crew (as Crew.kickoff_for_each does)
+        crew = create_scheduling_crew().copy()
         
         inputs = {
             "attendees": attendees,